@@ -80,23 +80,27 @@ class TDDFTNoHybrid(TDA):
         if wfnsym is not None and mol.symmetry:
             e_ia[sym_forbid] = 0
         d_ia = numpy.sqrt(e_ia)
-        ed_ia = e_ia * d_ia
         hdiag = e_ia.ravel() ** 2
+        # *2 for double occupancy, folded into the occupied orbitals once
+        orbo2 = orbo * 2
 
         vresp = mf.gen_response(singlet=singlet, hermi=1)
 
         def vind(zs):
             zs = numpy.asarray(zs).reshape(-1,nocc,nvir)
-            # *2 for double occupancy
-            dmov = lib.einsum('xov,ov,po,qv->xpq', zs, d_ia*2, orbo, orbv.conj())
+            dzs = zs * d_ia
+            # The contraction order is fixed to the one in uks.TDDFTNoHybrid
+            # instead of being planned on every call.
+            dmov = numpy.matmul(orbo2, numpy.matmul(dzs, orbv.T))
             # +cc for A+B and K_{ai,jb} in A == K_{ai,bj} in B
             dmov = dmov + dmov.conj().transpose(0,2,1)
 
             v1ao = vresp(dmov)
-            v1ov = lib.einsum('xpq,po,qv->xov', v1ao, orbo.conj(), orbv)
+            v1ov = numpy.matmul(numpy.matmul(orbo.T, v1ao), orbv)
 
-            # numpy.sqrt(e_ia) * (e_ia*d_ia*z + v1ov)
-            v1ov += numpy.einsum('xov,ov->xov', zs, ed_ia)
+            # numpy.sqrt(e_ia) * (e_ia*d_ia*z + v1ov), reusing d_ia*z in place
+            dzs *= e_ia
+            v1ov += dzs
             v1ov *= d_ia
             return v1ov.reshape(v1ov.shape[0],-1)
 
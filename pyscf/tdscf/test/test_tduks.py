@@ -79,6 +79,10 @@ class KnownValues(unittest.TestCase):
         e_ref = diagonalize(a, b, 6)
         self.assertAlmostEqual(abs(es[:3]-e_ref[:3]).max(), 0, 8)
         self.assertAlmostEqual(lib.fp(es[:3]*27.2114), 1.2946309669294163, 6)
+        self.assertEqual(td.X_alpha.shape[0], len(es))
+        self.assertTrue(td.X_beta.flags.c_contiguous)
+        self.assertAlmostEqual(abs(td.xy[1][0][0] - td.X_alpha[1]).max(), 0, 14)
+        self.assertAlmostEqual(abs(td.xy[2][1][1] - td.Y_beta[2]).max(), 0, 14)
 
     def test_nohbrid_b88p86(self):
         td = tdscf.uks.TDDFTNoHybrid(mf_bp86).set(conv_tol=1e-12)
@@ -88,6 +92,30 @@ class KnownValues(unittest.TestCase):
         self.assertAlmostEqual(abs(es[:3]-e_ref[:3]).max(), 0, 8)
         self.assertAlmostEqual(lib.fp(es[:3]*27.2114), 1.4624730971221087, 6)
 
+    def test_nohbrid_vind(self):
+        td = tdscf.uks.TDDFTNoHybrid(mf_lda)
+        vind, hdiag = td.get_vind(mf_lda)
+        a, b = td.get_ab()
+        nocc_a, nvir_a, nocc_b, nvir_b = a[1].shape
+        nov_a = nocc_a * nvir_a
+        nov_b = nocc_b * nvir_b
+        apb_ab = (a[1] + b[1]).reshape(nov_a,nov_b)
+        apb = numpy.vstack((numpy.hstack(((a[0]+b[0]).reshape(nov_a,nov_a), apb_ab)),
+                            numpy.hstack((apb_ab.T, (a[2]+b[2]).reshape(nov_b,nov_b)))))
+        # (A-B)^{1/2} (A+B) (A-B)^{1/2} with A-B = diag(e_ia)
+        d_ia = hdiag ** .25
+        ref = d_ia[:,None] * apb * d_ia
+
+        numpy.random.seed(1)
+        z = numpy.random.random((5,nov_a+nov_b))
+        hx1 = vind(z[:3])
+        hx1_copy = hx1.copy()
+        hx2 = vind(list(z[3:]))
+        # results of the earlier calls must not be overwritten by later calls
+        self.assertAlmostEqual(abs(hx1 - hx1_copy).max(), 0, 14)
+        self.assertAlmostEqual(abs(hx1 - z[:3].dot(ref.T)).max(), 0, 9)
+        self.assertAlmostEqual(abs(hx2 - z[3:].dot(ref.T)).max(), 0, 9)
+
     def test_tddft_lda(self):
         td = tdscf.uks.TDDFT(mf_lda).set(conv_tol=1e-12)
         es = td.kernel(nstates=4)[0] * 27.2114
@@ -32,6 +32,42 @@ from pyscf import __config__
 POSTIVE_EIG_THRESHOLD = getattr(__config__, 'tdscf_rhf_TDDFT_positive_eig_threshold', 1e-3)
 
 
+def _orbital_partition(mo_occ):
+    '''Indices (occidxa, occidxb, viridxa, viridxb) of the occupied and
+    virtual alpha and beta orbitals
+    '''
+    occidxa = (mo_occ[0] > 0).nonzero()[0]
+    occidxb = (mo_occ[1] > 0).nonzero()[0]
+    viridxa = (mo_occ[0] == 0).nonzero()[0]
+    viridxb = (mo_occ[1] == 0).nonzero()[0]
+    return occidxa, occidxb, viridxa, viridxb
+
+
+def _sym_allowed_blocks(orbsym_occ, orbsym_vir, wfnsym):
+    '''For each occupied irrep, the local indices (o, v) of the occupied and
+    virtual orbitals whose excitations o->v have the symmetry wfnsym
+    '''
+    blocks = []
+    for ir in numpy.unique(orbsym_occ):
+        o = numpy.where(orbsym_occ == ir)[0]
+        v = numpy.where(orbsym_vir == ir ^ wfnsym)[0]
+        if v.size > 0:
+            blocks.append((o, v))
+    return blocks
+
+
+def _buffer_view(buf, shape):
+    '''C-contiguous array of the given shape on the scratch space buf[0].
+    buf[0] is reallocated, at least doubling its size, if it is too small.
+    '''
+    size = int(numpy.prod(shape))
+    if buf[0] is None or buf[0].size < size:
+        if buf[0] is not None:
+            size = max(size, buf[0].size*2)
+        buf[0] = numpy.empty(size)
+    return numpy.ndarray(shape, buffer=buf[0])
+
+
 class TDA(uhf.TDA):
     def nuc_grad_method(self):
         from pyscf.grad import tduks
@@ -47,28 +83,66 @@ RPA = TDUKS = TDDFT
 
 class TDDFTNoHybrid(TDA):
     ''' Solve (A-B)(A+B)(X+Y) = (X+Y)w^2
+
+    Saved results (in addition to those of TDA):
+
+        X_alpha, X_beta, Y_alpha, Y_beta : 3D arrays
+            Excitation (X) and de-excitation (Y) amplitudes of all states,
+            shape [nstates,nocc,nvir] for each spin.  The arrays in xy are
+            views of these arrays.
     '''
+    # (orbidx, e_ia, sqrt(e_ia)) of the last get_vind call, read by kernel
+    _e_ia = None
+
+    def __init__(self, mf):
+        TDA.__init__(self, mf)
+        self.X_alpha = None
+        self.X_beta = None
+        self.Y_alpha = None
+        self.Y_beta = None
+        self._keys = self._keys.union(['X_alpha', 'X_beta', 'Y_alpha', 'Y_beta'])
+
+    def _get_e_ia(self, mf):
+        '''Orbital indices (occidxa, occidxb, viridxa, viridxb), orbital
+        energy differences e_ia and sqrt(e_ia) of the current mf.mo_energy
+        and mf.mo_occ.
+        '''
+        mo_energy = mf.mo_energy
+        mo_occ = mf.mo_occ
+        orbidx = _orbital_partition(mo_occ)
+        occidxa, occidxb, viridxa, viridxb = orbidx
+        e_ia_a = (mo_energy[0][viridxa,None] - mo_energy[0][occidxa]).T
+        e_ia_b = (mo_energy[1][viridxb,None] - mo_energy[1][occidxb]).T
+        e_ia = numpy.hstack((e_ia_a.reshape(-1), e_ia_b.reshape(-1)))
+        return orbidx, e_ia, numpy.sqrt(e_ia)
+
+    def check_sanity(self):
+        TDA.check_sanity(self)
+        assert(self._scf.mo_coeff[0].dtype == numpy.double)
+        return self
+
     def get_vind(self, mf):
+        '''Compute (A-B)^{1/2}(A+B)(A-B)^{1/2} z.
+        '''
         wfnsym = self.wfnsym
 
         mol = mf.mol
         mo_coeff = mf.mo_coeff
-        assert(mo_coeff[0].dtype == numpy.double)
-        mo_energy = mf.mo_energy
         mo_occ = mf.mo_occ
         nao, nmo = mo_coeff[0].shape
-        occidxa = numpy.where(mo_occ[0]>0)[0]
-        occidxb = numpy.where(mo_occ[1]>0)[0]
-        viridxa = numpy.where(mo_occ[0]==0)[0]
-        viridxb = numpy.where(mo_occ[1]==0)[0]
+        orbidx, e_ia, d_ia = self._e_ia = self._get_e_ia(mf)
+        occidxa, occidxb, viridxa, viridxb = orbidx
         nocca = len(occidxa)
         noccb = len(occidxb)
         nvira = len(viridxa)
         nvirb = len(viridxb)
-        orboa = mo_coeff[0][:,occidxa]
-        orbob = mo_coeff[1][:,occidxb]
-        orbva = mo_coeff[0][:,viridxa]
-        orbvb = mo_coeff[1][:,viridxb]
+        # Fortran order such that orbv.T and orbo.T in vind are C-contiguous
+        # operands for BLAS.  numpy usually returns this layout for the fancy
+        # indexing anyway, in which case asfortranarray does not copy.
+        orboa = numpy.asfortranarray(mo_coeff[0][:,occidxa])
+        orbob = numpy.asfortranarray(mo_coeff[1][:,occidxb])
+        orbva = numpy.asfortranarray(mo_coeff[0][:,viridxa])
+        orbvb = numpy.asfortranarray(mo_coeff[1][:,viridxb])
 
         if wfnsym is not None and mol.symmetry:
             if isinstance(wfnsym, str):
@@ -80,39 +154,128 @@ class TDDFTNoHybrid(TDA):
             sym_forbida = (orbsyma_in_d2h[occidxa,None] ^ orbsyma_in_d2h[viridxa]) != wfnsym
             sym_forbidb = (orbsymb_in_d2h[occidxb,None] ^ orbsymb_in_d2h[viridxb]) != wfnsym
             sym_forbid = numpy.hstack((sym_forbida.ravel(), sym_forbidb.ravel()))
+            # Only the (occ-irrep, vir-irrep) blocks allowed by wfnsym enter
+            # the contractions with the virtual orbitals in vind.  ov are the
+            # indices of the block elements in the flattened (nocc,nvir) axis.
+            blocksa = [(o, v, (o[:,None]*nvira+v).ravel(),
+                        numpy.asfortranarray(orbva[:,v])) for o, v in
+                       _sym_allowed_blocks(orbsyma_in_d2h[occidxa],
+                                           orbsyma_in_d2h[viridxa], wfnsym)]
+            blocksb = [(o, v, (o[:,None]*nvirb+v).ravel(),
+                        numpy.asfortranarray(orbvb[:,v])) for o, v in
+                       _sym_allowed_blocks(orbsymb_in_d2h[occidxb],
+                                           orbsymb_in_d2h[viridxb], wfnsym)]
+        else:
+            blocksa = blocksb = None
 
-        e_ia_a = (mo_energy[0][viridxa,None] - mo_energy[0][occidxa]).T
-        e_ia_b = (mo_energy[1][viridxb,None] - mo_energy[1][occidxb]).T
-        e_ia = numpy.hstack((e_ia_a.reshape(-1), e_ia_b.reshape(-1)))
         if wfnsym is not None and mol.symmetry:
-            e_ia[sym_forbid] = 0
-        d_ia = numpy.sqrt(e_ia).ravel()
-        ed_ia = e_ia.ravel() * d_ia
-        hdiag = e_ia.ravel() ** 2
+            # A new array, the unmasked e_ia in self._e_ia is used by kernel
+            e_ia = numpy.where(sym_forbid, 0, e_ia)
+            d_ia = numpy.sqrt(e_ia)
+        hdiag = e_ia ** 2
 
         vresp = mf.gen_response(mo_coeff, mo_occ, hermi=1)
 
+        # The dimensions are fixed for all calls of vind
+        nova = nocca * nvira
+        nov = nova + noccb * nvirb
+
+        # Bound once in the closure, numpy.matmul is called several times in
+        # every matvec
+        matmul = numpy.matmul
+
+        def z_dot_orbv(z, orbv, blocks, out):
+            '''z * orbv.T.  Symmetry forbidden blocks of z are skipped.'''
+            if blocks is None:
+                return matmul(z, orbv.T, out=out)
+            nz = z.shape[0]
+            z = z.reshape(nz,-1)
+            out[:] = 0
+            for o, v, ov, orbv_v in blocks:
+                zblk = _buffer_view(gather_buf, (nz,len(o),len(v)))
+                numpy.take(z, ov, axis=1, out=zblk.reshape(nz,-1), mode='clip')
+                zvblk = _buffer_view(prod_buf, (nz,len(o),nao))
+                out[:,o] = matmul(zblk, orbv_v.T, out=zvblk)
+            return out
+
+        def v1o_dot_orbv(v1o, orbv, blocks, out):
+            '''(orbo.T * v1ao) * orbv, evaluated for the symmetry allowed
+            blocks only.  The forbidden elements of out are set to 0.
+            '''
+            if blocks is None:
+                matmul(v1o, orbv, out=out)
+            else:
+                nz = v1o.shape[0]
+                out[:] = 0
+                for o, v, ov, orbv_v in blocks:
+                    v1o_o = _buffer_view(gather_buf, (nz,len(o),nao))
+                    numpy.take(v1o, o, axis=1, out=v1o_o, mode='clip')
+                    hblk = _buffer_view(prod_buf, (nz,len(o),len(v)))
+                    out[:,o[:,None],v] = matmul(v1o_o, orbv_v, out=hblk)
+            return out
+
+        # Scratch space kept across the Davidson iterations for d_ia*zs, for
+        # the AO densities and for the (nz,nocc,nao) intermediates of the
+        # contractions.  The AO densities are only read by vresp.  With
+        # symmetry, the gathered operands and the products of the irrep
+        # blocks have their own scratch space.
+        dzs_buf = [None]
+        dm1_buf = [None]
+        tmp_buf = [None]
+        gather_buf = [None]
+        prod_buf = [None]
+
+        # The three stages of vind operate on the whole block of trial
+        # vectors (nz of them) without a Python loop over the vectors.
+        def make_dm1(dzs):
+            '''Symmetrized AO transition densities (2,nz,nao,nao) of the
+            amplitudes dzs = d_ia*zs.
+            '''
+            nz = dzs.shape[0]
+            za = dzs[:,:nova].reshape(nz,nocca,nvira)
+            zb = dzs[:,nova:].reshape(nz,noccb,nvirb)
+            dmov = _buffer_view(dm1_buf, (2,nz,nao,nao))
+            # Contracting the virtual index first keeps the intermediate at
+            # the size of (nz,nocc,nao).
+            tmp = _buffer_view(tmp_buf, (nz,nocca,nao))
+            matmul(orboa, z_dot_orbv(za, orbva, blocksa, tmp), out=dmov[0])
+            tmp = _buffer_view(tmp_buf, (nz,noccb,nao))
+            matmul(orbob, z_dot_orbv(zb, orbvb, blocksb, tmp), out=dmov[1])
+            # +cc for A+B, symmetrized in place without a transposed copy
+            lib.hermi_sum(dmov.reshape(-1,nao,nao), axes=(0,2,1), inplace=True)
+            return dmov
+
+        def project_ov(v1ao):
+            '''Occupied-virtual blocks (nz,nov) of the AO response potentials
+            v1ao.
+            '''
+            nz = v1ao[0].shape[0]
+            # orbo.T * v1ao * orbv, contracting the occupied index first
+            # costs nz*nocc*nao*(nao+nvir), the cheaper order for nocc < nvir.
+            # The alpha and beta blocks are written into disjoint slices of hx.
+            # hx is not a reused buffer: lib.davidson1 keeps references to the
+            # rows of the returned vectors.
+            hx = numpy.empty((nz,nov))
+            tmp = _buffer_view(tmp_buf, (nz,nocca,nao))
+            v1o_dot_orbv(matmul(orboa.T, v1ao[0], out=tmp), orbva, blocksa,
+                         hx[:,:nova].reshape(nz,nocca,nvira))
+            tmp = _buffer_view(tmp_buf, (nz,noccb,nao))
+            v1o_dot_orbv(matmul(orbob.T, v1ao[1], out=tmp), orbvb, blocksb,
+                         hx[:,nova:].reshape(nz,noccb,nvirb))
+            return hx
+
         def vind(zs):
             nz = len(zs)
-            zs = numpy.asarray(zs).reshape(nz,-1)
-            if wfnsym is not None and mol.symmetry:
-                zs = numpy.copy(zs)
-                zs[:,sym_forbid] = 0
-
-            dmsa = (zs[:,:nocca*nvira] * d_ia[:nocca*nvira]).reshape(nz,nocca,nvira)
-            dmsb = (zs[:,nocca*nvira:] * d_ia[nocca*nvira:]).reshape(nz,noccb,nvirb)
-            dmsa = lib.einsum('xov,po,qv->xpq', dmsa, orboa, orbva.conj())
-            dmsb = lib.einsum('xov,po,qv->xpq', dmsb, orbob, orbvb.conj())
-            dmsa = dmsa + dmsa.conj().transpose(0,2,1)
-            dmsb = dmsb + dmsb.conj().transpose(0,2,1)
-
-            v1ao = vresp(numpy.asarray((dmsa,dmsb)))
-
-            v1a = lib.einsum('xpq,po,qv->xov', v1ao[0], orboa.conj(), orbva)
-            v1b = lib.einsum('xpq,po,qv->xov', v1ao[1], orbob.conj(), orbvb)
-
-            hx = numpy.hstack((v1a.reshape(nz,-1), v1b.reshape(nz,-1)))
-            hx += ed_ia * zs
+            zs = numpy.asarray(zs).reshape(nz,nov)
+            # d_ia vanishes for the symmetry forbidden excitations.  It masks
+            # zs through dzs and the final scaling of hx.
+            dzs = numpy.multiply(zs, d_ia, out=_buffer_view(dzs_buf, (nz,nov)))
+            v1ao = vresp(make_dm1(dzs))
+            hx = project_ov(v1ao)
+            # d_ia * (v1 + e_ia*d_ia*z), updated in place on the buffer of
+            # d_ia*z which is not needed once the densities are built
+            dzs *= e_ia
+            hx += dzs
             hx *= d_ia
             return hx
 
@@ -151,41 +314,37 @@ class TDDFTNoHybrid(TDA):
                               max_space=self.max_space, pick=pickeig,
                               verbose=log)
 
-        mo_energy = self._scf.mo_energy
-        mo_occ = self._scf.mo_occ
-        occidxa = numpy.where(mo_occ[0]>0)[0]
-        occidxb = numpy.where(mo_occ[1]>0)[0]
-        viridxa = numpy.where(mo_occ[0]==0)[0]
-        viridxb = numpy.where(mo_occ[1]==0)[0]
+        # Built by get_vind above.  mo_occ cannot change during davidson1.
+        orbidx, _, d_ia = self._e_ia
+        occidxa, occidxb, viridxa, viridxb = orbidx
         nocca = len(occidxa)
         noccb = len(occidxb)
         nvira = len(viridxa)
         nvirb = len(viridxb)
-        e_ia_a = (mo_energy[0][viridxa,None] - mo_energy[0][occidxa]).T
-        e_ia_b = (mo_energy[1][viridxb,None] - mo_energy[1][occidxb]).T
-        e_ia = numpy.hstack((e_ia_a.reshape(-1), e_ia_b.reshape(-1)))
-        e_ia = numpy.sqrt(e_ia)
-
-        e = []
-        xy = []
-        for i, z in enumerate(x1):
-            if w2[i] < POSTIVE_EIG_THRESHOLD**2:
-                continue
-            w = numpy.sqrt(w2[i])
-            zp = e_ia * z
-            zm = w/e_ia * z
-            x = (zp + zm) * .5
-            y = (zp - zm) * .5
-            norm = lib.norm(x)**2 - lib.norm(y)**2
-            if norm > 0:
-                norm = 1/numpy.sqrt(norm)
-                e.append(w)
-                xy.append(((x[:nocca*nvira].reshape(nocca,nvira) * norm,  # X_alpha
-                            x[nocca*nvira:].reshape(noccb,nvirb) * norm), # X_beta
-                           (y[:nocca*nvira].reshape(nocca,nvira) * norm,  # Y_alpha
-                            y[nocca*nvira:].reshape(noccb,nvirb) * norm)))# Y_beta
-        self.e = numpy.array(e)
-        self.xy = xy
+
+        # All roots are normalized in one pass
+        idx = numpy.where(w2 > POSTIVE_EIG_THRESHOLD**2)[0]
+        w = numpy.sqrt(w2[idx])
+        z = numpy.asarray(x1).reshape(len(w2),-1)[idx]
+        zp = d_ia * z
+        zm = w[:,None] / d_ia * z
+        x = (zp + zm) * .5
+        y = (zp - zm) * .5
+        norm = numpy.einsum('ij,ij->i', x, x) - numpy.einsum('ij,ij->i', y, y)
+        mask = norm > 0
+        norm = 1 / numpy.sqrt(norm[mask])
+        x = x[mask] * norm[:,None]
+        y = y[mask] * norm[:,None]
+
+        self.e = w[mask]
+        nroots = len(self.e)
+        nova = nocca * nvira
+        self.X_alpha = numpy.ascontiguousarray(x[:,:nova]).reshape(nroots,nocca,nvira)
+        self.X_beta  = numpy.ascontiguousarray(x[:,nova:]).reshape(nroots,noccb,nvirb)
+        self.Y_alpha = numpy.ascontiguousarray(y[:,:nova]).reshape(nroots,nocca,nvira)
+        self.Y_beta  = numpy.ascontiguousarray(y[:,nova:]).reshape(nroots,noccb,nvirb)
+        self.xy = [((xa, xb), (ya, yb)) for xa, xb, ya, yb in
+                   zip(self.X_alpha, self.X_beta, self.Y_alpha, self.Y_beta)]
 
         if self.chkfile:
             lib.chkfile.save(self.chkfile, 'tddft/e', self.e)